@@ -4,18 +4,31 @@ import datetime
 import os
 import sys
 import traceback
-from time import sleep
+import threading
 from collections import defaultdict, namedtuple
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import paramiko
 
 
-logfile_pattern = re.compile(r'(?P<network>[^_]+)_(?P<channel>.+)_(?P<date>[0-9]+)\.log')
+logfile_pattern = re.compile(r'(?P<network>[^_]+)_(?P<channel>.+)_(?P<date>[0-9]+)\.log', re.ASCII)
 
 LogFile = namedtuple("LogFile", "filename network channel date")
 
 
+def parse_log_name(fname):
+    """
+    Split a ZNC log file name into (network, channel, date). Names end with a fixed "_YYYYMMDD.log" suffix, so the common
+    case is parsed by offset; anything else falls back to logfile_pattern
+    """
+    if fname.endswith(".log") and fname[-13:-12] == "_" and fname[-12:-4].isascii() and fname[-12:-4].isdigit():
+        network, _, channel = fname[:-13].partition("_")
+        if network and channel:
+            return network, channel, datetime.datetime(int(fname[-12:-8]), int(fname[-8:-6]), int(fname[-6:-4]))
+    network, channel, date = logfile_pattern.match(fname).group("network", "channel", "date")
+    return network, channel, datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]))
+
+
 class ZNCLogFetcher(object):
     def __init__(self, host, user, ssh_key, znc_user_dir, output_dir, keep_days):
         """
@@ -33,15 +46,50 @@ class ZNCLogFetcher(object):
         self.output_dir = output_dir
         self.keep_days = keep_days
 
+        self._local = threading.local()
+        self._handshakes = threading.BoundedSemaphore(8)  # limits ssh connections being negotiated at once
+        self._clients = []
+
     def get_transport(self):
         """
         Create and return a new ssh connection
         """
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.client.WarningPolicy())
-        client.connect(self.host, username=self.user, pkey=self.ssh_key)
+        with self._handshakes:
+            client.connect(self.host, username=self.user, pkey=self.ssh_key)
         return client
 
+    def get_sftp(self):
+        """
+        Return an sftp session for the calling thread, connecting on first use or if the thread's connection has
+        dropped. The session is reused by every job the thread runs, see close()
+        """
+        client = getattr(self._local, "client", None)
+        if client is None or not client.get_transport() or not client.get_transport().is_active():
+            if client is not None:
+                # forget the dead connection first so a failed reconnect below is retried on the next call
+                self._local.client = self._local.sftp = None
+                self._clients.remove(client)
+                client.close()
+            client = self.get_transport()
+            try:
+                sftp = client.open_sftp()
+            except:
+                client.close()
+                raise
+            self._clients.append(client)
+            self._local.client, self._local.sftp = client, sftp
+        return self._local.sftp
+
+    def close(self):
+        """
+        Close the ssh connections opened by get_sftp()
+        """
+        for client in self._clients:
+            client.close()
+        self._clients = []
+
     def discover_znc_users(self):
         """
         Return a list of znc users by listing dirs in znc's user directory
@@ -54,29 +102,27 @@ class ZNCLogFetcher(object):
 
     def discover_user_logs(self, username, max_age=None):
         """
-        Lists items in user's ZNC log dir. Returns a dict organized by channel
+        Lists items in user's ZNC log dir. Returns a dict organized by (network, channel)
         """
-        with self.get_transport() as c:
-            sftp = c.open_sftp()
-            userlogdir = os.path.join(self.znc_user_dir, username, 'moddata/log')
-
+        sftp = self.get_sftp()
+        userlogdir = os.path.join(self.znc_user_dir, username, 'moddata/log')
+
+        try:
+            stat = sftp.stat(userlogdir)  # NOQA
+        except:
+            print("User {} has no logdir".format(username))
+            return {}
+        sftp.chdir(userlogdir)
+
+        by_channel = defaultdict(list)
+        logsiter = sftp.listdir_iter(userlogdir)
+        for logfile in logsiter:
             try:
-                stat = sftp.stat(userlogdir)  # NOQA
+                network, channel, log_date = parse_log_name(logfile.filename)
+                if not max_age or log_date < max_age:
+                    by_channel[(network, channel)].append(LogFile(logfile.filename, network, channel, log_date))
             except:
-                print("User {} has no logdir".format(username))
-                return {}
-            sftp.chdir(userlogdir)
-
-            by_channel = defaultdict(list)
-            logsiter = sftp.listdir_iter(userlogdir)
-            for logfile in logsiter:
-                try:
-                    network, channel, date = logfile_pattern.findall(logfile.filename)[0]
-                    log_date = datetime.datetime.strptime(date, '%Y%m%d')
-                    if not max_age or log_date < max_age:
-                        by_channel[channel].append(LogFile(logfile.filename, network, channel, log_date))
-                except:
-                    print("Could not parse: {}".format(logfile.filename))
+                print("Could not parse: {}".format(logfile.filename))
         return dict(by_channel)
 
     def run(self):
@@ -84,66 +130,54 @@ class ZNCLogFetcher(object):
 
         oldest_log = datetime.datetime.now() - datetime.timedelta(days=args.keep_days)
 
+        made_dirs = set()
         with ThreadPoolExecutor(max_workers=50) as tp:
-            for zncuser in users:
-                user_logs_by_channel = self.discover_user_logs(zncuser, max_age=oldest_log)
-                for channel, logfiles in user_logs_by_channel.items():
-
-                    # Sort by date
-                    logfiles = sorted(logfiles, key=lambda item: item.date)
-
-                    # make output dir
-                    for d in [
-                        os.path.join(self.output_dir),
-                        os.path.join(self.output_dir, zncuser),
-                        os.path.join(self.output_dir, zncuser, logfiles[0].network.lower())
-                    ]:
-                        try:
-                            os.mkdir(d)
-                        except:
-                            pass
-
-                    tp.submit(self.download_channel, zncuser, channel, logfiles)
+            # List every user's logs in parallel and start downloading each user's channels as soon as they're known
+            discoveries = {tp.submit(self.discover_user_logs, zncuser, max_age=oldest_log): zncuser for zncuser in users}
+            for discovery in as_completed(discoveries):
+                zncuser = discoveries[discovery]
+                user_logs_by_channel = discovery.result()
+                for (network, channel), logfiles in user_logs_by_channel.items():
+                    # make output dir, once per user/network
+                    netdir = os.path.join(self.output_dir, zncuser, network.lower())
+                    if netdir not in made_dirs:
+                        os.makedirs(netdir, exist_ok=True)
+                        made_dirs.add(netdir)
+
+                    tp.submit(self.download_channel, zncuser, network, channel, logfiles)
                     sys.stdout.write("+")
                     sys.stdout.flush()
-                    sleep(0.2)  # Prevents swarm of ssh connections
+        self.close()
 
-    def download_channel(self, username, channel, logfiles):
+    def download_channel(self, username, network, channel, logfiles):
         """
         Download a single channels logs and condense into monthly logs
         """
-        with self.get_transport() as c:
-            try:
-                sftp = c.open_sftp()
-                sftp.chdir(os.path.join(self.znc_user_dir, username, 'moddata/log'))
-
-                month_file = None
-                current_month = -1
-                for f in logfiles:
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                    if f.date.month != current_month:
-                        if month_file:
-                            month_file.close()
-                        month_file = open(os.path.join(args.output, username, f.network.lower(), "{}_{}{:02}.log"
-                                          .format(f.channel, f.date.year, f.date.month)), 'wb')
-                        current_month = f.date.month
-                    fh = sftp.open(f.filename)
-                    month_file.write("# BEGIN FILE '{}'\n".format(f.filename).encode("UTF-8"))
-                    while True:
-                        data = fh.read(4 * 1024 * 1024)
-                        if not data:
-                            break
-                        month_file.write(data)
-                    fh.close()
-                    month_file.write("# END FILE '{}'\n".format(f.filename).encode("UTF-8"))
-                if month_file:
-                    month_file.close()
-                sftp.close()
-                sys.stdout.write("finished {}".format(channel))
+        try:
+            logfiles = sorted(logfiles, key=lambda item: item.date)
+            sftp = self.get_sftp()
+            sftp.chdir(os.path.join(self.znc_user_dir, username, 'moddata/log'))
+
+            month_file = None
+            current_month = None
+            for f in logfiles:
+                sys.stdout.write(".")
                 sys.stdout.flush()
-            except:
-                print(traceback.format_exc())
+                if (f.date.year, f.date.month) != current_month:
+                    if month_file:
+                        month_file.close()
+                    month_file = open(os.path.join(args.output, username, network.lower(), "{}_{}{:02}.log"
+                                      .format(f.channel, f.date.year, f.date.month)), 'wb')
+                    current_month = (f.date.year, f.date.month)
+                month_file.write("# BEGIN FILE '{}'\n".format(f.filename).encode("UTF-8"))
+                sftp.getfo(f.filename, month_file)  # prefetches, keeping many reads in flight
+                month_file.write("# END FILE '{}'\n".format(f.filename).encode("UTF-8"))
+            if month_file:
+                month_file.close()
+            sys.stdout.write("finished {}".format(channel))
+            sys.stdout.flush()
+        except:
+            print(traceback.format_exc())
 
 
 if __name__ == '__main__':
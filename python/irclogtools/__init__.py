@@ -2,7 +2,7 @@
 import re
 from collections import namedtuple
 
-logfile_pattern = re.compile(r'((?P<network>[^_]+)_)?(?P<channel>.+)_(?P<date>[0-9]+)\.log')
+logfile_pattern = re.compile(r'((?P<network>[^_]+)_)?(?P<channel>.+)_(?P<date>[0-9]+)\.log', re.ASCII)
 LogFile = namedtuple("LogFile", "filename network channel date")
 
 __version__ = "0.0.0"
@@ -5,17 +5,21 @@ import datetime
 import argparse
 from collections import defaultdict
 from tabulate import tabulate
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-from irclogtools.containers import CombinedLogfile
+from irclogtools.containers import CombinedLogfile, LogFile
 from irclogtools.tools import discover_logfiles
 
 
 def archiveit(output_dir, _channel, _logfiles):
+    """
+    Add logs to a channel's archive. _logfiles is a list of (name, dir) tuples rather than `LogFile`s as this runs in
+    a worker process and they are cheaper to send
+    """
     fout = os.path.join(output_dir, "{}.log".format(_channel))
     log = CombinedLogfile(fout)
-    for item in _logfiles:
-        log.add_section(item)
+    for name, root in _logfiles:
+        log.add_section(LogFile(name, root=root))
     log.write()
 
 
@@ -68,10 +72,8 @@ def main():
     if args.action == "import":
         os.makedirs(args.output, exist_ok=True)
 
-        logs = discover_logfiles(args.dir)
-
         by_channel = defaultdict(list)
-        for log in logs:
+        for log in discover_logfiles(args.dir):
             if not args.all and not log.channel.startswith("#"):
                 continue
             by_channel[log.channel].append(log)
@@ -79,9 +81,20 @@ def main():
         _display = [[k, len(v)] for k, v in by_channel.items()]
         print(tabulate(sorted(_display, key=lambda x: x[0].lower()), headers=["channel", "num logs"]) + "\n")
 
-        with ProcessPoolExecutor(max_workers=os.cpu_count() * 2) as tp:
+        # One process per core, each building one channel's archive at a time. Largest channels go first so a big
+        # channel isn't left running alone at the end. Only a couple of jobs per worker are queued at once, and
+        # results are checked as they finish so any error from a worker is raised instead of dropped
+        max_pending = 2 * os.cpu_count()
+        pending = set()
+        with ProcessPoolExecutor() as pp:
             for channel, logfiles in sorted(by_channel.items(), key=lambda x: by_totalsize(x[1]), reverse=True):
-                tp.submit(archiveit, args.output, channel, logfiles)
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        job.result()
+                pending.add(pp.submit(archiveit, args.output, channel, [(log.name, log.dir) for log in logfiles]))
+            for job in as_completed(pending):
+                job.result()
 
     elif args.action == "inspect":
         log = CombinedLogfile(args.file)
@@ -99,10 +112,9 @@ def main():
             total_bytes = 0
             total_lines = 0
             for portion in log.data:
-                data = portion.contents()
-                size = len(data)
+                size = portion.bytes()
                 total_bytes += size
-                lines = len(data.split(b"\n"))
+                lines = portion.lines()
                 total_lines += lines
                 info.append([portion.name,
                              portion.network,
@@ -1,63 +1,122 @@
 import os
+import re
+import mmap
+import shutil
 import datetime
 import json
+from operator import attrgetter
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 from irclogtools import logfile_pattern
 
 
+date_key = attrgetter("date")
+
+
+def json_dumps(obj):
+    # Always the stdlib encoder, so archives are byte-identical whether or not orjson is installed. json.dumps escapes
+    # non-ascii characters so its output can take the ascii fast path
+    return json.dumps(obj, sort_keys=True).encode("ascii")
+
+
+def count_newlines(data, chunk_size=1024 * 1024):
+    """
+    Count newlines in a bytes-like object. memoryviews have no count(), so they are counted a chunk at a time
+    """
+    if isinstance(data, bytes):
+        return data.count(b"\n")
+    return sum(data[i:i + chunk_size].tobytes().count(b"\n") for i in range(0, len(data), chunk_size))
+
+
+def count_lines(data):
+    """
+    Count lines in a bytes-like object, including an unterminated last line
+    """
+    return count_newlines(data) + (1 if len(data) and data[-1:] != b"\n" else 0)
+
+
 class CombinedLogfile(object):
     HEADER = "#$$$COMBINEDLOG"
     PORTIONHEADER = "#$$$BEGINPORTION"
     ENDPORTIONHEADER = "#$$$ENDPORTION"
+    HEADER_B = HEADER.encode("ascii")
+    PORTIONHEADER_B = PORTIONHEADER.encode("ascii")
+    ENDPORTIONHEADER_B = ENDPORTIONHEADER.encode("ascii")
+    WRITE_BUFFER = 1024 * 1024
+    SINGLE_WRITE_LIMIT = 64 * 1024 * 1024  # archives smaller than this are written with a single write() call
+    PORTION_PATTERN = re.compile(rb'^#\$\$\$(?P<kind>BEGIN|END)PORTION(?P<meta>[^\n]*)\n?', re.M)
 
     def __init__(self, fpath):
         self.path = fpath
         self.data = []
+        self._by_date = {}  # portion date -> portion, for constant time duplicate checks
+        self._range = None  # cached (start, end) of portion dates, see get_range()
+        self._mmap = None  # backs the contents of parsed portions
+        self._sorted = True  # whether self.data is known to be in date order
         if os.path.exists(self.path):
             self._parse()
         # TODO maybe an interface to limit the date range of added stuff?
 
     def _parse(self):
         """
-        Open the logfile and load each section into memory
+        Open the logfile and index each section. The file is mmap'd and portion markers are located with a regex
+        rather than reading line by line. Where a portion's metadata records its size the end marker is checked for
+        directly past the body, so bodies are never scanned. Portion bodies are memoryviews into the map, so their
+        contents are only paged in when used
         """
         with open(self.path, "rb") as f:
             # Read the magic header
-            header = f.readline().decode("UTF-8")
-            assert self.HEADER and header[0:len(self.HEADER)] == self.HEADER, "Invalid header!"
-
-            channel = None
-            network = None
-
-            meta = None
-            portion = None
-
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-
-                if line.startswith(self.PORTIONHEADER.encode("UTF-8")):
-                    assert portion is None and meta is None, "Started portion while already in portion?"
-                    meta = json.loads(line.decode("UTF-8").split(" ", 1)[1].strip())
-                    portion = b''
-                    if not channel:
-                        channel = meta["channel"]
-                    if not network:
-                        network = meta["network"]
-                    assert channel == meta["channel"], "Portion does not match first portion's channel"
-                    # assert network == meta["network"], "Portion does not match first portion's network"
-
-                elif line.startswith(self.ENDPORTIONHEADER.encode("UTF-8")):
-                    assert portion is not None and meta is not None, "Ended portion while not in portion?"
-                    self.data.append(VirtualLogFile(meta["name"], portion))
-                    portion = None
-                    meta = None
-
-                else:
-                    portion += line
-
-            assert portion is None and meta is None, "Unexpected EOF during open portion"
+            header = f.readline()
+            assert header.startswith(self.HEADER_B), "Invalid header!"
+
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self._mmap)
+
+        channel = None
+        network = None
+
+        pos = len(header)
+        while True:
+            begin = self.PORTION_PATTERN.search(self._mmap, pos)
+            if not begin:
+                break
+            assert begin.group("kind") == b"BEGIN", "Ended portion while not in portion?"
+
+            meta = json_loads(begin.group("meta"))
+            if not channel:
+                channel = meta["channel"]
+            if not network:
+                network = meta["network"]
+            assert channel == meta["channel"], "Portion does not match first portion's channel"
+            # assert network == meta["network"], "Portion does not match first portion's network"
+
+            end = self._find_portion_end(begin.end(), meta["name"], meta.get("size"))
+            assert end, "Unexpected EOF during open portion"
+            assert end.group("kind") == b"END", "Started portion while already in portion?"
+
+            self._index(VirtualLogFile(meta["name"], view[begin.end():end.start()]))
+            pos = end.end()
+
+    def _find_portion_end(self, body_start, name, size=None):
+        """
+        Return the marker match following the portion body starting at body_start. If the body's size is known the end
+        marker for name should be right after it, or one byte later if write() had to terminate the body with a
+        newline. Otherwise, or if the size was wrong, search forward for the next marker
+        """
+        if size is not None:
+            name = name.encode("UTF-8")
+            for offset in (body_start + size, body_start + size + 1):
+                match = self.PORTION_PATTERN.match(self._mmap, offset)
+                if match and match.group("kind") == b"END" and match.group("meta").strip() == name:
+                    return match
+        return self.PORTION_PATTERN.search(self._mmap, body_start)
 
     def write(self, target_path=None, raw=False):
         """
@@ -75,93 +134,147 @@ class CombinedLogfile(object):
 
         the metadata is json and must be sorted by key. network may be null but no other fields may be. date must be
         formatted as above and name, the original file name, must match by irclogtools.logfile_pattern.
+
+        The output is written to a temporary file alongside target_path which is then moved into place, as parsed
+        portions may still be reading from the file being replaced. Symlinks are followed and an existing file's mode
+        is kept.
         """
         if not target_path:
             target_path = self.path
+        target_path = os.path.realpath(target_path)
 
         channel = self.data[0].channel
         print("{}: writing {}{} portions".format(target_path, len(self.data), " raw" if raw else ''))
 
-        with open(target_path, "wb") as f:
-            # Write the magic header
-            if not raw:
-                f.write("{} '{}'\n".format(self.HEADER, channel).encode("UTF-8"))
-
-            # Put portions in order
-            self.sort()
-
-            # Write each portion
-            for section in self.data:
-                if not raw:
-                    meta = {"name": section.name,
-                            "network": section.network,
-                            "channel": section.channel,
-                            "date": section.date.strftime("%Y%m%d"),
-                            "lines": section.lines(),
-                            "size": section.bytes()}
-                    f.write("{} {}\n".format(self.PORTIONHEADER, json.dumps(meta, sort_keys=True)).encode("UTF-8"))
+        tmp_path = os.path.join(os.path.dirname(target_path),
+                                ".{}.ilogtmp-{}".format(os.path.basename(target_path), os.getpid()))
+        try:
+            self._write(tmp_path, channel, raw)
+            if os.path.exists(target_path):
+                shutil.copymode(target_path, tmp_path)
+            os.replace(tmp_path, target_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _write(self, target_path, channel, raw):
+        # Put portions in order
+        self.sort()
+
+        with open(target_path, "wb", buffering=self.WRITE_BUFFER) as f:
+            if sum(section.bytes() for section in self.data) < self.SINGLE_WRITE_LIMIT:
+                # Small archives are assembled in memory and handed to the OS in one write
+                f.write(b"".join(self._serialize(channel, raw)))
+            else:
+                # Larger ones are streamed, with on-disk logs copied by the kernel rather than read into memory
+                for chunk in self._serialize(channel, raw, copy_files=True):
+                    if isinstance(chunk, tuple):
+                        section, size = chunk
+                        section.copy_to(f, size)
+                    else:
+                        f.write(chunk)
+
+    def _serialize(self, channel, raw, copy_files=False):
+        """
+        Yield the chunks of bytes making up the archive (or raw log lines). If copy_files is set, the bodies of on-disk
+        LogFiles are yielded as a (LogFile, size) tuple, to be copied with LogFile.copy_to()
+        """
+        # The magic header
+        if not raw:
+            yield b"%s '%s'\n" % (self.HEADER_B, channel.encode("UTF-8"))
+
+        # Each portion's header, body and trailer
+        for i, section in enumerate(self.data):
+            if copy_files and i + 1 < len(self.data):
+                # Have the next portion read in the background while this one is copied. Not worth it otherwise, as the
+                # next log is read straight away with nothing to overlap
+                self.data[i + 1].prefetch()
+            if copy_files and not isinstance(section, VirtualLogFile):
+                contents = section
+            else:
                 contents = section.contents()
-                f.write(contents)
-                if not raw:
-                    if not contents.endswith(b"\n"):
-                        f.write(b"\n")
-                    f.write("{} {}\n".format(self.ENDPORTIONHEADER, section.name).encode("UTF-8"))
+            if raw:
+                yield (section, section.measure()[1]) if contents is section else contents
+                continue
+            if contents is section:
+                lines, size, last_byte = section.measure()
+                contents = (section, size)
+            else:
+                # Count from the contents already in hand rather than having the section read itself again
+                lines, size, last_byte = count_lines(contents), len(contents), contents[-1:]
+            meta = {"name": section.name,
+                    "network": section.network,
+                    "channel": section.channel,
+                    "date": "%04d%02d%02d" % (section.date.year, section.date.month, section.date.day),
+                    "lines": lines,
+                    "size": size}
+            yield b"%s %s\n" % (self.PORTIONHEADER_B, json_dumps(meta))
+            yield contents
+            if last_byte != b"\n":
+                yield b"\n"
+            yield b"%s %s\n" % (self.ENDPORTIONHEADER_B, section.name.encode("UTF-8"))
 
     def sort(self):
-        self.data.sort(key=lambda x: x.date)
+        if not self._sorted:
+            self.data.sort(key=date_key)
+            self._sorted = True
 
     def add_section(self, section):
         """
-        Add a portion (as a LogFile object) to the log file. If a portion with matching dates exists, it will
-        be replaced
+        Add a portion (as a LogFile object) to the log file. If a portion with a matching date already exists, the
+        new portion is ignored
+        """
+        if self.data:
+            assert section.channel == self.data[0].channel
+        if section.date in self._by_date:
+            return
+        self._index(section)
+
+    def _index(self, section):
+        """
+        Append a portion to self.data and record it in the date index and cached range
         """
-        for s in self.data:
-            assert section.channel == s.channel
-            if s.date == section.date:
-                return
+        if self._sorted and self.data and section.date < self.data[-1].date:
+            self._sorted = False
+        self._by_date[section.date] = section
         self.data.append(section)
+        if self._range:
+            self._range = (min(self._range[0], section.date), max(self._range[1], section.date), )
 
     def get_range(self):
         """
         Return (start, end) datetime tuple of sections
         """
-        start = self.data[0].date
-        end = self.data[0].date
-
-        for item in self.data:
-            if item.date > end:
-                end = item.date
-            if item.date < start:
-                start = item.date
-
-        return (start, end, )
+        if self._range is None:
+            self._range = (min(self._by_date), max(self._by_date), )
+        return self._range
 
     def limit(self, end=None, start=None):
         """
         Drop all portions newer than end or older than start
         """
         assert end or start, "Need an start, end, or both"
-        for item in self.data[:]:
-            if (end and item.date > end) or (start and item.date < start):
-                self.data.remove(item)
+        self.data = [item for item in self.data
+                     if not ((end and item.date > end) or (start and item.date < start))]
+        self._by_date = {item.date: item for item in self.data}
+        self._range = None
 
 
 class LogFile(object):
 
-    def __init__(self, fname, root=None):
+    def __init__(self, fname, root=None, size=None):
         self.dir = root
         self.name = fname
         self.network = None
         self.channel = None
         self.date = None  # datetime object for this channel
+        self._size = size  # cached by bytes() if not known up front. May be stale, so not used when writing
         self._parse()
 
     def _parse(self):
-        matches = logfile_pattern.match(self.name).groupdict()
-        self.network = matches["network"]
-        self.channel = matches["channel"]
-        date = matches["date"]
-        self.date = datetime.datetime.strptime(date, '%Y%m%d')
+        self.network, self.channel, date = logfile_pattern.match(self.name).group("network", "channel", "date")
+        self.date = datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]))
 
     def contents(self):
         """
@@ -174,14 +287,58 @@ class LogFile(object):
         """
         Return line count
         """
+        return self.measure()[0]
+
+    def measure(self):
+        """
+        Return (line count, size, final byte) of the log as it is now. All three come from a single read of the file,
+        bounded by its size when opened, so they agree with each other even if the log is being appended to
+        """
         lines = 0
+        size = 0
+        last = b""
         with open(os.path.join(self.dir, self.name), "rb") as f:
-            for _ in f.readlines():
-                lines += 1
-        return lines
+            remaining = os.fstat(f.fileno()).st_size
+            for chunk in iter(lambda: f.read(min(1024 * 1024, remaining - size)), b""):
+                lines += chunk.count(b"\n")
+                size += len(chunk)
+                last = chunk[-1:]
+        # an unterminated last line still counts
+        return lines + (1 if last not in (b"", b"\n") else 0), size, last
 
     def bytes(self):
-        return os.path.getsize(os.path.join(self.dir, self.name))
+        if self._size is None:
+            self._size = os.path.getsize(os.path.join(self.dir, self.name))
+        return self._size
+
+    def prefetch(self):
+        """
+        Ask the kernel to start reading the log into the page cache, without waiting for it
+        """
+        if hasattr(os, "posix_fadvise"):
+            with open(os.path.join(self.dir, self.name), "rb") as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+    def copy_to(self, fout, size):
+        """
+        Append the first size bytes of the log to the binary file object fout, raising IOError if the log is shorter.
+        Where available os.sendfile is used so the data is copied within the kernel instead of passing through python
+        """
+        fout.flush()
+        copied = 0
+        with open(os.path.join(self.dir, self.name), "rb") as fin:
+            if hasattr(os, "sendfile"):
+                while copied < size:
+                    sent = os.sendfile(fout.fileno(), fin.fileno(), copied, size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+            else:
+                for chunk in iter(lambda: fin.read(min(1024 * 1024, size - copied)), b""):
+                    fout.write(chunk)
+                    copied += len(chunk)
+        if copied != size:
+            raise IOError("{}: expected {} bytes but copied {}".format(self.name, size, copied))
 
     @staticmethod
     def create(fname):
@@ -201,8 +358,11 @@ class VirtualLogFile(LogFile):
     def contents(self):
         return self.data
 
+    def prefetch(self):
+        pass
+
     def lines(self):
-        return len(self.data.split(b'\n'))
+        return count_lines(self.data)
 
     def bytes(self):
         return len(self.data)
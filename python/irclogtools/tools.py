@@ -5,12 +5,10 @@ from irclogtools.containers import LogFile
 
 def discover_logfiles(path):
     """
-    Given a path, return a list of LogFile objects representing the contents
+    Given a path, yield LogFile objects representing the contents
     """
     root = os.path.abspath(os.path.normpath(path))
-    logs = []
-    for fname in os.listdir(path):
-        fabspath = os.path.join(root, fname)
-        if os.path.isfile(fabspath):
-            logs.append(LogFile.create(fabspath))
-    return logs
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield LogFile(entry.name, root=root, size=entry.stat().st_size)
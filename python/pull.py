@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 import logging
 import datetime
+import errno
+import itertools
 import os
 import sys
+import shutil
+import threading
 
-from time import sleep
+from queue import LifoQueue
+from contextlib import contextmanager
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 
@@ -16,11 +21,58 @@ import re
 
 from collections import namedtuple
 
-logfile_pattern = re.compile(r'(?P<network>[^_]+)_(?P<channel>[^_]+)_(?P<date>[0-9]+)\.log')
-LogFile = namedtuple("LogFile", "filename network channel date")
+logfile_pattern = re.compile(r'(?P<network>[^_]+)_(?P<channel>[^_]+)_(?P<date>[0-9]+)\.log', re.ASCII)
+LogFile = namedtuple("LogFile", "filename network channel date size")
 FutureTrack = namedtuple("FutureTrack", "username channel future")
 
 
+class SSHPool(object):
+    def __init__(self, connect, size=8, sessions=10):
+        """
+        A fixed number of ssh connections shared between jobs. Each connection can carry several sessions at once, so
+        it is handed out up to `sessions` times concurrently; callers open their own sftp session on it.
+
+        :param connect: callable returning a new, connected paramiko.SSHClient
+        :param size: number of ssh connections to open
+        :param sessions: number of concurrent users of each connection. sshd's MaxSessions defaults to 10
+        """
+        self.connect = connect
+        self.clients = [None] * size
+        self.locks = [threading.Lock() for _ in range(size)]
+        # Slots are interleaved so concurrent jobs are spread across connections, and handed out last-in-first-out so
+        # a lone job reuses the connection that was just released rather than opening another
+        self.slots = LifoQueue()
+        for _ in range(sessions):
+            for i in range(size):
+                self.slots.put(i)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Check out a connection, connecting (or reconnecting) it first if needed. Blocks while all slots are in use
+        """
+        i = self.slots.get()
+        try:
+            with self.locks[i]:
+                client = self.clients[i]
+                if client is None or not client.get_transport() or not client.get_transport().is_active():
+                    if client is not None:
+                        # release the dead connection's socket and transport thread. Any sessions still open on it
+                        # have already failed along with it
+                        client.close()
+                        self.clients[i] = None
+                    client = self.clients[i] = self.connect()
+            yield client
+        finally:
+            self.slots.put(i)
+
+    def close(self):
+        for client in self.clients:
+            if client:
+                client.close()
+        self.clients = [None] * len(self.clients)
+
+
 class ZNCLogFetcher(object):
     def __init__(self, host, user, ssh_key, znc_user_dir, output_dir, keep_days, ignore_map={}):
         """
@@ -42,6 +94,8 @@ class ZNCLogFetcher(object):
         self.ignore_map = ignore_map
 
         self.download_workers = 50
+        self.copy_buffer = 1024 * 1024
+        self.pool = SSHPool(self.get_transport)
 
     def get_transport(self):
         """
@@ -50,15 +104,14 @@ class ZNCLogFetcher(object):
         logging.debug("Connecting using {}@{}".format(self.user, self.host))
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.client.WarningPolicy())
-        client.connect(self.host, username=self.user, pkey=self.ssh_key, compress=True)
+        client.connect(self.host, username=self.user, pkey=self.ssh_key)
         return client
 
     def discover_znc_users(self):
         """
         Return a list of znc users by listing dirs in znc's user directory
         """
-        with self.get_transport() as c:
-            sftp = c.open_sftp()
+        with self.pool.acquire() as c, c.open_sftp() as sftp:
             sftp.chdir(self.znc_user_dir)
             users = sftp.listdir()
         # users = ["voice_of_reason"]  # ["xMopxShell2", "voice_of_reason"]
@@ -67,28 +120,34 @@ class ZNCLogFetcher(object):
 
     def discover_user_logs(self, username, max_age=None):
         """
-        Lists items in user's ZNC log dir. Returns a dict organized by channel
+        Lists items in user's ZNC log dir. Returns a dict organized by (network, channel)
         """
         logging.info("Discovering logs for {}".format(username))
-        with self.get_transport() as c:
-            sftp = c.open_sftp()
+        with self.pool.acquire() as c, c.open_sftp() as sftp:
             userlogdir = os.path.join(self.znc_user_dir, username, 'moddata/log')
 
+            # Entries are parsed as listdir_iter streams them in; it keeps several READDIR requests in flight
+            by_channel = defaultdict(list)
+            listing = sftp.listdir_iter(userlogdir)
             try:
-                stat = sftp.stat(userlogdir) # NOQA
-            except:
+                # the dir is opened when the first entry is requested. Only a missing dir is skipped, other errors here
+                # or later in the listing are raised
+                first = next(listing, None)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
                 print("User {} has no logdir".format(username))
-                return []
-            sftp.chdir(userlogdir)
-
-            by_channel = defaultdict(list)
-            logsiter = sftp.listdir_iter(userlogdir)
-            for logfile in logsiter:
+                return {}
+            if first is not None:
+                listing = itertools.chain((first, ), listing)
+            for logfile in listing:
                 try:
-                    network, channel, date = logfile_pattern.findall(logfile.filename)[0]
-                    log_date = datetime.datetime.strptime(date, '%Y%m%d')
+                    match = logfile_pattern.search(logfile.filename)
+                    network, channel, date = match.group("network", "channel", "date")
+                    log_date = datetime.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8]))
                     if not max_age or log_date < max_age:
-                        by_channel[channel].append(LogFile(logfile.filename, network, channel, log_date))
+                        by_channel[(network, channel)].append(LogFile(logfile.filename, network, channel, log_date,
+                                                                      logfile.st_size))
                 except:
                     print("Could not parse: {}".format(logfile.filename))
         logging.info("Discover logs: found {} channels for {}".format(len(by_channel.keys()), username))
@@ -96,9 +155,9 @@ class ZNCLogFetcher(object):
         by_channel = dict(by_channel)
 
         if username in self.ignore_map:
-            for channel in self.ignore_map[username]:
-                if channel in by_channel:
-                    del by_channel[channel]
+            for network, channel in list(by_channel.keys()):
+                if channel in self.ignore_map[username]:
+                    del by_channel[(network, channel)]
                     logging.info("Ignored {} for user {}".format(channel, username))
 
         return by_channel
@@ -109,35 +168,24 @@ class ZNCLogFetcher(object):
         oldest_log = datetime.datetime.now() - datetime.timedelta(days=args.keep_days)
 
         futures = []
-        jobs_added = 0
+        made_dirs = set()
         is_clean = True
         with ThreadPoolExecutor(max_workers=self.download_workers) as tp:
             for zncuser in users:
                 user_logs_by_channel = self.discover_user_logs(zncuser, max_age=oldest_log)
                 logging.info("Queuing jobs for {}".format(zncuser))
-                for channel, logfiles in user_logs_by_channel.items():
-
-                    # Sort by date
-                    logfiles = sorted(logfiles, key=lambda item: item.date)
-
-                    # make output dir
-                    for d in [
-                        os.path.join(self.output_dir),
-                        os.path.join(self.output_dir, zncuser),
-                        os.path.join(self.output_dir, zncuser, logfiles[0].network)
-                    ]:
-                        try:
-                            os.mkdir(d)
-                        except:
-                            pass
+                for (network, channel), logfiles in user_logs_by_channel.items():
+                    # make output dir, once per user/network
+                    key = (zncuser, network)
+                    if key not in made_dirs:
+                        os.makedirs(os.path.join(self.output_dir, *key), exist_ok=True)
+                        made_dirs.add(key)
 
                     logging.info("Queuing {}:{}".format(zncuser, channel))
                     futures.append(FutureTrack(username=zncuser,
                                                channel=channel,
-                                               future=tp.submit(self.download_channel, zncuser, channel, logfiles)))
-                    jobs_added += 1
-                    if jobs_added < self.download_workers * 3:
-                        sleep(0.1)  # Prevents swarm of ssh connections
+                                               future=tp.submit(self.download_channel, zncuser, network, channel,
+                                                                logfiles)))
                 logging.info("Finished queuing jobs")
             for future in futures:
                 try:
@@ -145,38 +193,44 @@ class ZNCLogFetcher(object):
                 except Exception as e:
                     is_clean = False
                     logging.critical("FAILED TO DOWNLOAD: {}: {}({})".format(future, e.__class__.__name__, str(e)))
+        self.pool.close()
         return is_clean
 
-    def download_channel(self, username, channel, logfiles):
+    def download_channel(self, username, network, channel, logfiles):
         """
         Download a single channels logs and condense into monthly logs
         """
+        logfiles = sorted(logfiles, key=lambda item: item.date)
         logging.info("Starting channel {} for {}. {} files to download".format(channel, username, len(logfiles)))
-        with self.get_transport() as c:
-            sftp = c.open_sftp()
+        with self.pool.acquire() as c, c.open_sftp() as sftp:
             sftp.chdir(os.path.join(self.znc_user_dir, username, 'moddata/log'))
 
             month_file = None
-            current_month = -1
+            current_month = None
             for f in logfiles:
                 logging.debug("Downloading {}".format(f.filename))
-                if f.date.month != current_month:
+                if (f.date.year, f.date.month) != current_month:
                     if month_file:
                         month_file.close()
-                    month_file = open(os.path.join(args.output, username, f.network,
+                    month_file = open(os.path.join(args.output, username, network,
                                                    "{}_{}{:02}.log".format(f.channel, f.date.year, f.date.month)),
-                                      'wb')
-                    current_month = f.date.month
-                fh = sftp.open(f.filename)
-                month_file.write("# BEGIN FILE '{}'\n".format(f.filename).encode("UTF-8"))
-                while True:
-                    data = fh.read(4096 * 1024)
-                    if not data:
-                        break
-                    month_file.write(data)
-                fh.close()
-                month_file.write("# END FILE '{}'\n".format(f.filename).encode("UTF-8"))
-            sftp.close()
+                                      'wb', buffering=self.copy_buffer)
+                    current_month = (f.date.year, f.date.month)
+                begin_marker = "# BEGIN FILE '{}'\n".format(f.filename).encode("UTF-8")
+                end_marker = "# END FILE '{}'\n".format(f.filename).encode("UTF-8")
+                with sftp.open(f.filename, 'rb') as fh:
+                    # pipeline reads of the whole file rather than one round trip per block. Passing the size from
+                    # the listing saves prefetch() a stat round trip
+                    fh.prefetch(f.size)
+                    if f.size < self.copy_buffer:
+                        # small files go into the month file's buffer with their markers in one call
+                        month_file.writelines((begin_marker, fh.read(), end_marker))
+                    else:
+                        month_file.write(begin_marker)
+                        shutil.copyfileobj(fh, month_file, self.copy_buffer)
+                        month_file.write(end_marker)
+            if month_file:
+                month_file.close()
         logging.info("Finished channel {} for {}".format(channel, username))
         return True
 
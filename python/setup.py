@@ -10,4 +10,5 @@ setup(name='irclogtools',
       author='dpedu',
       author_email='dave@davepedu.com',
       packages=['irclogtools'],
+      extras_require={'fast': ['orjson']},
       entry_points={'console_scripts': ['ilogarchive=irclogtools.archive:main']})